@@ -14,54 +14,89 @@ See this comment for design rationale:
 https://github.com/pytorch/vision/pull/1321#issuecomment-531033978
 """
 
+import functools
+import io
 import os.path
+import types
+from collections.abc import Mapping
 
 import jinja2
 import yaml
 from jinja2 import select_autoescape
 
+try:
+    from yaml import CSafeDumper as _Dumper
+except ImportError:
+    from yaml import SafeDumper as _Dumper
+
+
+class _NoAliasDumper(_Dumper):
+    # The generated workflows share read-only sub-dicts (e.g. gen_binary_filters());
+    # emit them inline instead of as &id001 anchors / *id001 aliases.
+    def ignore_aliases(self, data):
+        return True
+
+
+_NoAliasDumper.add_representer(types.MappingProxyType, _NoAliasDumper.represent_dict)
+
 
 PYTHON_VERSIONS = ["3.7", "3.8", "3.9", "3.10"]
 
+# CircleCI tag filter for release candidates. This is emitted verbatim into
+# config.yml (the surrounding slashes mark it as a regex for CircleCI), so it
+# is kept as a raw string rather than a compiled Python pattern.
 RC_PATTERN = r"/v[0-9]+(\.[0-9]+)*-rc[0-9]+/"
 
+_CU_VERSIONS = {
+    "linux": ("cpu", "cu116", "cu117", "rocm5.1.1", "rocm5.2"),
+    "win": ("cpu", "cu116", "cu117"),
+    "macos": ("cpu",),
+}
+
+# cu_version -> (manylinux wheel image, conda builder image). ROCm conda
+# packages not yet supported, hence no conda image for them.
+_IMAGES = {
+    "cpu": ("pytorch/manylinux-cpu", "pytorch/conda-builder:cpu"),
+    "cu116": ("pytorch/manylinux-cuda116", "pytorch/conda-builder:cuda116"),
+    "cu117": ("pytorch/manylinux-cuda117", "pytorch/conda-builder:cuda117"),
+    "rocm5.1.1": ("pytorch/manylinux-rocm:5.1.1", None),
+    "rocm5.2": ("pytorch/manylinux-rocm:5.2", None),
+}
+
+# (btype, os_type, cu_versions) combinations that produce binary jobs, in
+# generation order. ROCm conda packages not yet supported.
+_BINARY_MATRIX = tuple(
+    (btype, os_type, tuple(cu for cu in _CU_VERSIONS[os_type] if not (btype == "conda" and cu.startswith("rocm"))))
+    for btype in ("wheel", "conda")
+    for os_type in ("linux", "macos", "win")
+)
+
+# Shared by every generated "filters" entry, hence read-only
+_TAG_ONLY = types.MappingProxyType({"only": RC_PATTERN})
+
 
 def build_workflows(prefix="", filter_branch=None, upload=False, indentation=6, windows_latest_only=False):
     w = []
-    for btype in ["wheel", "conda"]:
-        for os_type in ["linux", "macos", "win"]:
-            python_versions = PYTHON_VERSIONS
-            cu_versions_dict = {
-                "linux": ["cpu", "cu116", "cu117", "rocm5.1.1", "rocm5.2"],
-                "win": ["cpu", "cu116", "cu117"],
-                "macos": ["cpu"],
-            }
-            cu_versions = cu_versions_dict[os_type]
-            for python_version in python_versions:
-                for cu_version in cu_versions:
-                    # ROCm conda packages not yet supported
-                    if cu_version.startswith("rocm") and btype == "conda":
-                        continue
-                    for unicode in [False]:
-                        fb = filter_branch
-                        if (
-                            windows_latest_only
-                            and os_type == "win"
-                            and filter_branch is None
-                            and (
-                                python_version != python_versions[-1]
-                                or (cu_version not in [cu_versions[0], cu_versions[-1]])
-                            )
-                        ):
-                            fb = "main"
-                        if not fb and (
-                            os_type == "linux" and cu_version == "cpu" and btype == "wheel" and python_version == "3.7"
-                        ):
-                            # the fields must match the build_docs "requires" dependency
-                            fb = "/.*/"
-                        w += workflow_pair(
-                            btype, os_type, python_version, cu_version, unicode, prefix, upload, filter_branch=fb
-                        )
+    name_prefix = f"{prefix}binary"
+    for btype, os_type, cu_versions in _BINARY_MATRIX:
+        # Only the latest Python with the first and last cu_version run on every PR for Windows
+        latest_only = windows_latest_only and os_type == "win" and filter_branch is None
+        latest_allowed = frozenset((PYTHON_VERSIONS[-1], cu) for cu in (cu_versions[0], cu_versions[-1]))
+        for python_version in PYTHON_VERSIONS:
+            for cu_version in cu_versions:
+                fb = filter_branch
+                if latest_only and (python_version, cu_version) not in latest_allowed:
+                    fb = "main"
+                if not fb and (
+                    os_type == "linux" and cu_version == "cpu" and btype == "wheel" and python_version == "3.7"
+                ):
+                    # the fields must match the build_docs "requires" dependency
+                    fb = "/.*/"
+                w.extend(
+                    _iter_workflow_pair(
+                        btype, os_type, python_version, cu_version, name_prefix, upload, filter_branch=fb
+                    )
+                )
 
     if not filter_branch:
         # Build on every pull request, but upload only on nightly and tags
@@ -70,26 +105,21 @@ def build_workflows(prefix="", filter_branch=None, upload=False, indentation=6,
     return indent(indentation, w)
 
 
-def workflow_pair(btype, os_type, python_version, cu_version, unicode, prefix="", upload=False, *, filter_branch=None):
-
-    w = []
-    unicode_suffix = "u" if unicode else ""
-    base_workflow_name = f"{prefix}binary_{os_type}_{btype}_py{python_version}{unicode_suffix}_{cu_version}"
+def _iter_workflow_pair(
+    btype, os_type, python_version, cu_version, name_prefix="binary", upload=False, *, filter_branch=None
+):
+    base_workflow_name = "_".join((name_prefix, os_type, btype, "py" + python_version, cu_version))
 
-    w.append(
-        generate_base_workflow(
-            base_workflow_name, python_version, cu_version, unicode, os_type, btype, filter_branch=filter_branch
-        )
+    yield generate_base_workflow(
+        base_workflow_name, python_version, cu_version, os_type, btype, filter_branch=filter_branch
     )
 
     if upload:
-        w.append(generate_upload_workflow(base_workflow_name, os_type, btype, cu_version, filter_branch=filter_branch))
+        yield generate_upload_workflow(base_workflow_name, os_type, btype, cu_version, filter_branch=filter_branch)
         # disable smoke tests, they are broken and needs to be fixed
         # if filter_branch == "nightly" and os_type in ["linux", "win"]:
         #     pydistro = "pip" if btype == "wheel" else "conda"
-        #     w.append(generate_smoketest_workflow(pydistro, base_workflow_name, filter_branch, python_version, os_type))
-
-    return w
+        #     yield generate_smoketest_workflow(pydistro, base_workflow_name, filter_branch, python_version, os_type)
 
 
 def build_doc_job(filter_branch):
@@ -121,34 +151,7 @@ def upload_doc_job(filter_branch):
     return [{"upload_docs": job}]
 
 
-manylinux_images = {
-    "cu116": "pytorch/manylinux-cuda116",
-    "cu117": "pytorch/manylinux-cuda117",
-}
-
-
-def get_manylinux_image(cu_version):
-    if cu_version == "cpu":
-        return "pytorch/manylinux-cpu"
-    elif cu_version.startswith("cu"):
-        cu_suffix = cu_version[len("cu") :]
-        return f"pytorch/manylinux-cuda{cu_suffix}"
-    elif cu_version.startswith("rocm"):
-        rocm_suffix = cu_version[len("rocm") :]
-        return f"pytorch/manylinux-rocm:{rocm_suffix}"
-
-
-def get_conda_image(cu_version):
-    if cu_version == "cpu":
-        return "pytorch/conda-builder:cpu"
-    elif cu_version.startswith("cu"):
-        cu_suffix = cu_version[len("cu") :]
-        return f"pytorch/conda-builder:cuda{cu_suffix}"
-
-
-def generate_base_workflow(
-    base_workflow_name, python_version, cu_version, unicode, os_type, btype, *, filter_branch=None
-):
+def generate_base_workflow(base_workflow_name, python_version, cu_version, os_type, btype, *, filter_branch=None):
 
     d = {
         "name": base_workflow_name,
@@ -156,29 +159,25 @@ def generate_base_workflow(
         "cu_version": cu_version,
     }
 
-    if os_type != "win" and unicode:
-        d["unicode_abi"] = "1"
-
     if os_type != "win":
-        d["wheel_docker_image"] = get_manylinux_image(cu_version)
-        # ROCm conda packages not yet supported
-        if "rocm" not in cu_version:
-            d["conda_docker_image"] = get_conda_image(cu_version)
+        wheel_docker_image, conda_docker_image = _IMAGES[cu_version]
+        d["wheel_docker_image"] = wheel_docker_image
+        if conda_docker_image is not None:
+            d["conda_docker_image"] = conda_docker_image
 
     if filter_branch is not None:
-        d["filters"] = {
-            "branches": {"only": filter_branch},
-            "tags": {
-                # Using a raw string here to avoid having to escape
-                # anything
-                "only": r"/v[0-9]+(\.[0-9]+)*-rc[0-9]+/"
-            },
-        }
+        d["filters"] = gen_binary_filters(filter_branch)
 
     w = f"binary_{os_type}_{btype}"
     return {w: d}
 
 
+@functools.lru_cache(maxsize=None)
+def gen_binary_filters(filter_branch):
+    # One shared, read-only filters mapping per branch for all binary workflows
+    return types.MappingProxyType({"branches": types.MappingProxyType({"only": filter_branch}), "tags": _TAG_ONLY})
+
+
 def gen_filter_branch_tree(*branches, tags_list=None):
     filter_dict = {"branches": {"only": [b for b in branches]}}
     if tags_list is not None:
@@ -197,14 +196,7 @@ def generate_upload_workflow(base_workflow_name, os_type, btype, cu_version, *,
         d["subfolder"] = "" if os_type == "macos" else cu_version + "/"
 
     if filter_branch is not None:
-        d["filters"] = {
-            "branches": {"only": filter_branch},
-            "tags": {
-                # Using a raw string here to avoid having to escape
-                # anything
-                "only": r"/v[0-9]+(\.[0-9]+)*-rc[0-9]+/"
-            },
-        }
+        d["filters"] = gen_binary_filters(filter_branch)
 
     return {f"binary_{btype}_upload": d}
 
@@ -227,8 +219,112 @@ def generate_smoketest_workflow(pydistro, base_workflow_name, filter_branch, pyt
     return {f"smoke_test_{os_type}_{pydistro}": d}
 
 
+class _UnsupportedYAML(Exception):
+    # Raised by the specialized emitter for anything outside the shape it handles
+    pass
+
+
+def _yaml_scalar(value):
+    # Only plain ASCII strings are handled; anything PyYAML would render
+    # differently (other types, escapes, block scalars, ...) is rejected.
+    if (
+        not isinstance(value, str)
+        or not value.isascii()
+        or not value.isprintable()
+        or value != value.strip()
+        or value.endswith(":")
+    ):
+        raise _UnsupportedYAML(value)
+    # Mirror PyYAML's plain-vs-quoted decision for the strings we emit: quote
+    # anything that would otherwise be read back as a non-string (e.g. '3.10').
+    if (
+        not value
+        or value.startswith(("---", "..."))
+        or value[0] in ",[]{}#&*!|>'\"%@`"
+        or (value[0] in "-?:" and value[1:2] in ("", " "))
+        or ": " in value
+        or " #" in value
+        or any(regexp.match(value) for _, regexp in _Dumper.yaml_implicit_resolvers.get(value[0], ()))
+    ):
+        return "'" + value.replace("'", "''") + "'"
+    return value
+
+
+def _yaml_key(key):
+    # PyYAML switches to "? key" notation for keys of 128+ characters
+    if _yaml_scalar(key) != key or len(key) >= 128:
+        raise _UnsupportedYAML(key)
+    return key
+
+
+def _yaml_value(value, column):
+    # PyYAML folds scalars containing spaces once they run past its 80 column width;
+    # column is measured in PyYAML's own output, i.e. before indent() re-indents it
+    scalar = _yaml_scalar(value)
+    if " " in scalar and column + len(scalar) > 80:
+        raise _UnsupportedYAML(value)
+    return scalar
+
+
+def _emit_mapping(out, mapping, level, pad):
+    if not mapping:
+        raise _UnsupportedYAML(mapping)
+    # Validate keys before sorting; mixed key types would not compare
+    keys = [_yaml_key(key) for key in mapping]
+    for key in sorted(keys):
+        value = mapping[key]
+        out.write(f"{pad}{' ' * level}{key}:")
+        if isinstance(value, Mapping):
+            _emit_mapping(out, value, level + 2, pad)
+        elif isinstance(value, list):
+            if not value:
+                raise _UnsupportedYAML(value)
+            for item in value:
+                out.write(f"{pad}{' ' * level}- {_yaml_value(item, level + 2)}")
+        else:
+            out.write(f" {_yaml_value(value, level + len(key) + 2)}")
+
+
+def _emit_workflow_list(items, indent_spaces):
+    # Specialized emitter for the shape produced by the *_workflows() helpers:
+    # a non-empty list of single-key dicts whose values are mappings of strings,
+    # lists of strings and nested filter mappings. Matches
+    # yaml.dump(default_flow_style=False); raises _UnsupportedYAML otherwise.
+    if not items:
+        raise _UnsupportedYAML(items)
+    out = io.StringIO()
+    pad = "\n" + " " * indent_spaces
+    for item in items:
+        if not isinstance(item, dict) or len(item) != 1:
+            raise _UnsupportedYAML(item)
+        for key, value in item.items():
+            if not isinstance(value, Mapping):
+                raise _UnsupportedYAML(value)
+            out.write(f"{pad}- {_yaml_key(key)}:")
+            _emit_mapping(out, value, 4, pad)
+    return out.getvalue()[len(pad) :]
+
+
+def _dump_yaml(indentation, data_list):
+    # Generic (slower) PyYAML path. Items are dumped one at a time to keep the
+    # emitter's buffer small.
+    if not data_list:
+        return yaml.dump(data_list, Dumper=_NoAliasDumper, default_flow_style=False).rstrip("\n")
+    pad = "\n" + " " * indentation
+    return pad.join(
+        yaml.dump([item], Dumper=_NoAliasDumper, default_flow_style=False).rstrip("\n").replace("\n", pad)
+        for item in data_list
+    )
+
+
 def indent(indentation, data_list):
-    return ("\n" + " " * indentation).join(yaml.dump(data_list, default_flow_style=False).splitlines())
+    # REGENERATE_USE_PYYAML=1 forces the PyYAML path to validate the specialized emitter
+    if not os.environ.get("REGENERATE_USE_PYYAML"):
+        try:
+            return _emit_workflow_list(data_list, indentation)
+        except _UnsupportedYAML:
+            pass
+    return _dump_yaml(indentation, data_list)
 
 
 def unittest_workflows(indentation=6):
@@ -326,22 +422,30 @@ def android_workflows(indentation=6, nightly=False):
     return indent(indentation, jobs)
 
 
+_ENV = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(os.path.dirname(__file__)),
+    lstrip_blocks=True,
+    autoescape=select_autoescape(enabled_extensions=("html", "xml")),
+    keep_trailing_newline=True,
+    auto_reload=False,
+)
+
+
 if __name__ == "__main__":
-    d = os.path.dirname(__file__)
-    env = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(d),
-        lstrip_blocks=True,
-        autoescape=select_autoescape(enabled_extensions=("html", "xml")),
-        keep_trailing_newline=True,
-    )
+    try:
+        # Default directory is a private per-user _jinja2-cache-<uid> that Jinja permission-checks
+        _ENV.bytecode_cache = jinja2.FileSystemBytecodeCache()
+    except (OSError, RuntimeError):
+        # The cache is optional; regenerate without it if the directory is unusable
+        pass
 
-    with open(os.path.join(d, "config.yml"), "w") as f:
-        f.write(
-            env.get_template("config.yml.in").render(
-                build_workflows=build_workflows,
-                unittest_workflows=unittest_workflows,
-                cmake_workflows=cmake_workflows,
-                ios_workflows=ios_workflows,
-                android_workflows=android_workflows,
-            )
-        )
+    d = os.path.dirname(__file__)
+    # A buffer larger than the generated file turns the streamed chunks into a single write
+    with open(os.path.join(d, "config.yml"), "w", buffering=1 << 20) as f:
+        _ENV.get_template("config.yml.in").stream(
+            build_workflows=build_workflows,
+            unittest_workflows=unittest_workflows,
+            cmake_workflows=cmake_workflows,
+            ios_workflows=ios_workflows,
+            android_workflows=android_workflows,
+        ).dump(f)